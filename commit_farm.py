@@ -1,34 +1,106 @@
 #!/usr/bin/env python3
 
 import argparse
+import faulthandler
 import os
 import sys
 import time
 import json
 import random
+import re
+import selectors
 import signal
 import subprocess
+import traceback
+from collections import deque
 from datetime import datetime, timedelta
-from typing import List, Optional, Tuple
-
-
-STATE_FILE_NAME = "state.json"
+from typing import Deque, Dict, List, NamedTuple, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional; state I/O falls back to the stdlib json module
+    orjson = None  # type: ignore[assignment]
+
+# Dump Python stacks to stderr on fatal signals (segfault, abort), and on
+# `kill -USR1 <pid>` so a running daemon can be inspected without restarting
+faulthandler.enable()
+if hasattr(signal, "SIGUSR1"):
+    faulthandler.register(signal.SIGUSR1)
+
+
+STATE_FILE_NAME = "state.jsonl"
+# Pre-log state file: one JSON object {"date", "scheduled_times": [iso, ...]}
+LEGACY_STATE_FILE_NAME = "state.json"
+# Rewrite the state log as a single snapshot once it grows past this many lines
+STATE_COMPACT_LINES = 50
+# Scheduled times this close to the one being committed are folded into the same commit
+COALESCE_WINDOW_SECONDS = 5
 DEFAULT_COMMIT_FILE = "farm_activity.md"
+# Resolved once at import; the script's location does not change while it runs
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+_STATE_PATH = os.path.join(_SCRIPT_DIR, STATE_FILE_NAME)
+_LEGACY_STATE_PATH = os.path.join(_SCRIPT_DIR, LEGACY_STATE_FILE_NAME)
+# Daemon-private generator for schedules and phrases; seeded from FARM_SEED when set
+_RNG = random.Random()
+ACTIVITY_PHRASES = [
+    "Automated maintenance",
+    "Routine update",
+    "Sync notes",
+    "Housekeeping",
+    "Keep-alive",
+    "Log entry",
+    "Notes refresh",
+]
+# KEY=value, KEY="value" or KEY='value'; unquoted values run to end of line (spaces allowed)
+_DOTENV_RE = re.compile(r"""^\s*([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(?:"([^"]*)"|'([^']*)'|(.*?))\s*$""")
+
+
+class ScheduledCommit(NamedTuple):
+    time: datetime
+    # Activity-log phrase picked when the schedule is generated
+    phrase: str
 
 
 class GracefulKiller:
     def __init__(self) -> None:
         self.should_terminate = False
+        # Self-pipe: the interpreter writes a byte to it on every signal, so a
+        # select() on the read end wakes up immediately on SIGINT/SIGTERM
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        signal.set_wakeup_fd(self._wakeup_w)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
         signal.signal(signal.SIGINT, self._handler)
         signal.signal(signal.SIGTERM, self._handler)
 
     def _handler(self, signum, frame) -> None:  # type: ignore[no-untyped-def]
         self.should_terminate = True
 
+    def sleep(self, seconds: float) -> None:
+        # Wait until a fixed monotonic deadline or until a signal arrives
+        deadline = time.monotonic() + seconds
+        while not self.should_terminate:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return
+            if self._selector.select(timeout):
+                self._drain_wakeup()
+
+    def _drain_wakeup(self) -> None:
+        try:
+            while os.read(self._wakeup_r, 512):
+                pass
+        except BlockingIOError:
+            pass
+
 
 def log(message: str) -> None:
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] {message}", flush=True)
+    # time.strftime formats the local time directly, without building a datetime
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+    sys.stdout.write(f"[{timestamp}] {message}\n")
+    sys.stdout.flush()
 
 
 def load_env_from_dotenv(dotenv_path: str) -> None:
@@ -36,28 +108,23 @@ def load_env_from_dotenv(dotenv_path: str) -> None:
         return
     try:
         with open(dotenv_path, "r", encoding="utf-8") as f:
-            for line in f:
-                stripped = line.strip()
-                if not stripped or stripped.startswith("#"):
-                    continue
-                if "=" not in stripped:
-                    continue
-                key, value = stripped.split("=", 1)
-                key = key.strip()
-                value = value.strip().strip('"').strip("'")
-                if key and value and key not in os.environ:
-                    os.environ[key] = value
+            lines = f.read().splitlines()
     except Exception as exc:
         log(f"Warning: Failed to read .env file: {exc}")
-
-
-def get_script_dir() -> str:
-    return os.path.dirname(os.path.abspath(__file__))
+        return
+    for line in lines:
+        # Blank lines, comments and lines without KEY= simply don't match
+        match = _DOTENV_RE.match(line)
+        if not match:
+            continue
+        key = match.group(1)
+        value = match.group(2) or match.group(3) or match.group(4)
+        if value:
+            os.environ.setdefault(key, value)
 
 
 def read_config() -> dict:
-    script_dir = get_script_dir()
-    dotenv_path = os.path.join(script_dir, ".env")
+    dotenv_path = os.path.join(_SCRIPT_DIR, ".env")
     load_env_from_dotenv(dotenv_path)
 
     config = {
@@ -73,6 +140,7 @@ def read_config() -> dict:
         "git_push": os.environ.get("GIT_PUSH", "true").lower() in ("1", "true", "yes", "on"),
         "git_user_name": os.environ.get("USER_NAME", ""),
         "git_user_email": os.environ.get("USER_EMAIL", ""),
+        "farm_seed": os.environ.get("FARM_SEED", ""),
     }
 
     # Validate and normalize
@@ -104,19 +172,32 @@ def read_config() -> dict:
         log("ERROR: MIN_COMMITS cannot be greater than MAX_COMMITS.")
         sys.exit(1)
 
+    if config["farm_seed"]:
+        try:
+            _RNG.seed(int(config["farm_seed"]))
+        except ValueError:
+            log(f"ERROR: FARM_SEED must be an integer. Got {config['farm_seed']}")
+            sys.exit(1)
+
     return config
 
 
-def run_git_command(args: List[str], cwd: str, allow_fail: bool = False) -> Tuple[int, str, str]:
+def run_git_command(
+    args: List[str], cwd: str, allow_fail: bool = False, capture: bool = True
+) -> Tuple[int, str, str]:
+    # With capture=False stdout goes to /dev/null and "" is returned for it;
+    # stderr is always captured for error reporting
     try:
         env = os.environ.copy()
         # Prevent any interactive password/username prompts that could hang the process
         env["GIT_TERMINAL_PROMPT"] = "0"
         env["GIT_ASKPASS"] = "true"
+        # Untranslated messages: perform_commit matches on git's English output
+        env["LC_ALL"] = "C"
         proc = subprocess.run(
             ["git", *args],
             cwd=cwd,
-            stdout=subprocess.PIPE,
+            stdout=subprocess.PIPE if capture else subprocess.DEVNULL,
             stderr=subprocess.PIPE,
             stdin=subprocess.DEVNULL,
             text=True,
@@ -125,7 +206,7 @@ def run_git_command(args: List[str], cwd: str, allow_fail: bool = False) -> Tupl
         )
         if proc.returncode != 0 and not allow_fail:
             log(f"git {' '.join(args)} failed: {proc.stderr.strip()}")
-        return proc.returncode, proc.stdout, proc.stderr
+        return proc.returncode, proc.stdout or "", proc.stderr
     except FileNotFoundError:
         log("ERROR: git not found in PATH")
         sys.exit(1)
@@ -138,38 +219,157 @@ def ensure_git_repo(repo_path: str) -> None:
         sys.exit(1)
 
 
-def maybe_set_git_identity(repo_path: str, name: str, email: str) -> None:
+# Caches the repo's git config for the process lifetime: one `git config --list`
+# replaces a spawn per key lookup.
+class GitSession:
+    def __init__(self, repo_path: str) -> None:
+        self.repo_path = repo_path
+        self._config: Optional[Dict[str, str]] = None
+
+    def config(self) -> Dict[str, str]:
+        if self._config is None:
+            self._config = {}
+            code, out, _ = run_git_command(["config", "--list", "-z"], self.repo_path, allow_fail=True)
+            if code == 0:
+                # -z output is "key\nvalue\0" per entry, which survives values containing "=" or newlines
+                for entry in out.split("\0"):
+                    if not entry:
+                        continue
+                    key, _, value = entry.partition("\n")
+                    self._config[key] = value
+        return self._config
+
+    def get_config(self, key: str) -> str:
+        return self.config().get(key, "")
+
+    def set_config(self, key: str, value: str) -> None:
+        code, _, _ = run_git_command(["config", key, value], self.repo_path, allow_fail=True, capture=False)
+        if code == 0:
+            self.config()[key] = value
+
+
+def maybe_set_git_identity(session: GitSession, name: str, email: str) -> None:
     if not name or not email:
         return
-    # Set only if not configured at repo level
-    code_name, out_name, _ = run_git_command(["config", "--get", "user.name"], repo_path, allow_fail=True)
-    code_email, out_email, _ = run_git_command(["config", "--get", "user.email"], repo_path, allow_fail=True)
-    if code_name != 0 or not out_name.strip():
-        run_git_command(["config", "user.name", name], repo_path, allow_fail=True)
-    if code_email != 0 or not out_email.strip():
-        run_git_command(["config", "user.email", email], repo_path, allow_fail=True)
+    # Set only if not already configured
+    if not session.get_config("user.name").strip():
+        session.set_config("user.name", name)
+    if not session.get_config("user.email").strip():
+        session.set_config("user.email", email)
+
+
+def _json_dumps(obj: object) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
 
 
-def state_file_path() -> str:
-    return os.path.join(get_script_dir(), STATE_FILE_NAME)
+def _json_loads(data: bytes) -> object:
+    # orjson.JSONDecodeError subclasses ValueError, like json's
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# Number of lines currently in the state log, used to decide when to compact
+_state_log_lines = 0
 
 
 def read_state() -> dict:
-    path = state_file_path()
+    # The state file is an append-only log: a {"date", "schedule"} snapshot of
+    # [iso, phrase] pairs followed by {"used": iso} lines for each consumed time.
+    # Replay it, then parse the surviving entries once into a sorted deque.
+    global _state_log_lines
+    path = _STATE_PATH
+    if not os.path.isfile(path):
+        _migrate_legacy_state()
     if not os.path.isfile(path):
         return {}
+    state: dict = {}
+    lines = 0
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    record = _json_loads(line)
+                except ValueError:
+                    # A torn line from a crash mid-append; the rest of the log is still valid
+                    continue
+                if not isinstance(record, dict):
+                    continue
+                lines += 1
+                if "schedule" in record:
+                    state = {"date": record.get("date"), "scheduled_times": list(record["schedule"])}
+                elif "used" in record and state:
+                    used = record["used"]
+                    state["scheduled_times"] = [e for e in state["scheduled_times"] if e[0] != used]
     except Exception:
         return {}
+    if state:
+        scheduled_times: List[ScheduledCommit] = []
+        for entry in state["scheduled_times"]:
+            try:
+                iso_ts, phrase = entry
+                scheduled_times.append(ScheduledCommit(datetime.fromisoformat(iso_ts), phrase))
+            except (TypeError, ValueError):
+                continue
+        state["scheduled_times"] = deque(sorted(scheduled_times))
+    _state_log_lines = lines
+    return state
+
+
+def _migrate_legacy_state() -> None:
+    # Carry an upgraded daemon's state.json over as the first log snapshot, so a
+    # mid-day restart resumes today's schedule instead of generating a new one
+    if not os.path.isfile(_LEGACY_STATE_PATH):
+        return
+    try:
+        with open(_LEGACY_STATE_PATH, "r", encoding="utf-8") as f:
+            legacy = json.load(f)
+        scheduled_times = [
+            ScheduledCommit(datetime.fromisoformat(iso_ts), _RNG.choice(ACTIVITY_PHRASES))
+            for iso_ts in legacy.get("scheduled_times", [])
+        ]
+    except Exception as exc:
+        log(f"Warning: Ignoring unreadable legacy state file: {exc}")
+        return
+    write_state({"date": legacy.get("date"), "scheduled_times": sorted(scheduled_times)})
+    if os.path.isfile(_STATE_PATH):
+        os.remove(_LEGACY_STATE_PATH)
+        log(f"Migrated {LEGACY_STATE_FILE_NAME} to {STATE_FILE_NAME}.")
 
 
 def write_state(state: dict) -> None:
-    path = state_file_path()
+    # Replace the log with a fresh snapshot; done once per schedule refresh.
+    # Written to a temp file and renamed so a crash never leaves a truncated log.
+    # No fsync: losing the last write only means a regenerated or replayed schedule.
+    global _state_log_lines
+    path = _STATE_PATH
+    tmp_path = f"{path}.tmp"
+    record = {
+        "date": state.get("date"),
+        "schedule": [[e.time.isoformat(), e.phrase] for e in state.get("scheduled_times", [])],
+    }
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(state, f, indent=2)
+        with open(tmp_path, "wb") as f:
+            f.write(_json_dumps(record) + b"\n")
+        os.replace(tmp_path, path)
+        _state_log_lines = 1
+    except Exception as exc:
+        log(f"Warning: Failed to write state file: {exc}")
+
+
+def record_used_times(state: dict, used: List[ScheduledCommit]) -> None:
+    # Append consumed times to the log instead of rewriting the whole schedule
+    global _state_log_lines
+    if _state_log_lines >= STATE_COMPACT_LINES:
+        write_state(state)
+        return
+    path = _STATE_PATH
+    try:
+        with open(path, "ab") as f:
+            f.write(b"".join(_json_dumps({"used": e.time.isoformat()}) + b"\n" for e in used))
+        _state_log_lines += len(used)
     except Exception as exc:
         log(f"Warning: Failed to write state file: {exc}")
 
@@ -185,7 +385,7 @@ def generate_schedule_for_today(
     end_hour: int,
     min_commits: int,
     max_commits: int,
-) -> List[str]:
+) -> List[ScheduledCommit]:
     now = datetime.now()
     day_start = now.replace(hour=start_hour, minute=0, second=0, microsecond=0)
     day_end = now.replace(hour=end_hour, minute=0, second=0, microsecond=0)
@@ -199,78 +399,70 @@ def generate_schedule_for_today(
     if total_seconds <= 0:
         return []
 
-    commit_count = random.randint(min_commits, max_commits)
+    commit_count = _RNG.randint(min_commits, max_commits)
 
     # Sample unique offsets to spread commits across the window
     # If commit_count exceeds total_seconds, we'll clamp (unlikely in practice)
     commit_count = min(commit_count, max(1, total_seconds))
 
-    offsets = sorted(random.sample(range(total_seconds), commit_count))
-    times: List[str] = []
-    for offset in offsets:
-        scheduled_time = day_start + timedelta(seconds=offset)
-        # Skip times already in the past; we only keep future times
-        if scheduled_time <= now:
-            continue
-        times.append(scheduled_time.isoformat())
+    offsets = sorted(_RNG.sample(range(total_seconds), commit_count))
+    # Skip times already in the past; we only keep future times
+    times = [t for t in (day_start + timedelta(seconds=offset) for offset in offsets) if t > now]
+    phrases = _RNG.choices(ACTIVITY_PHRASES, k=len(times))
 
-    return times
+    return [ScheduledCommit(t, phrase) for t, phrase in zip(times, phrases)]
 
 
-def next_scheduled_time(scheduled_iso_times: List[str]) -> Optional[datetime]:
-    if not scheduled_iso_times:
-        return None
-    for iso_ts in scheduled_iso_times:
-        try:
-            scheduled_dt = datetime.fromisoformat(iso_ts)
-            if scheduled_dt > datetime.now():
-                return scheduled_dt
-        except Exception:
-            continue
-    return None
+def next_scheduled_time(scheduled_times: Deque[ScheduledCommit], now: datetime) -> Optional[datetime]:
+    # scheduled_times is kept sorted, so the earliest entry is the next one
+    return scheduled_times[0].time if scheduled_times and scheduled_times[0].time > now else None
 
 
-def append_activity_line(repo_path: str, commit_file: str) -> None:
+def ensure_activity_file(repo_path: str, commit_file: str) -> str:
+    # Done once at startup so the per-commit append is a single open()
     file_path = os.path.join(repo_path, commit_file)
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-
-    phrases = [
-        "Automated maintenance",
-        "Routine update",
-        "Sync notes",
-        "Housekeeping",
-        "Keep-alive",
-        "Log entry",
-        "Notes refresh",
-    ]
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    phrase = random.choice(phrases)
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
 
     # Ensure file exists with a header
     if not os.path.exists(file_path):
         with open(file_path, "w", encoding="utf-8") as f:
             f.write("# Activity Log\n\n")
 
-    with open(file_path, "a", encoding="utf-8") as f:
+    return file_path
+
+
+def append_activity_line(file_path: str, when: datetime, phrase: str) -> None:
+    timestamp = when.strftime("%Y-%m-%d %H:%M:%S")
+    with open(file_path, "a", encoding="utf-8", buffering=8192) as f:
         f.write(f"- {timestamp} — {phrase}\n")
 
 
 def perform_commit(repo_path: str, commit_file: str, commit_message_template: str, push: bool) -> None:
-    run_git_command(["add", commit_file], repo_path)
     commit_message = f"{commit_message_template} ({datetime.now().isoformat(timespec='seconds')})"
-    code, _, err = run_git_command(["commit", "-m", commit_message], repo_path, allow_fail=True)
+    # --only stages and commits the file in one process instead of add + commit
+    code, out, err = run_git_command(["commit", "-o", commit_file, "-m", commit_message], repo_path, allow_fail=True)
+    if code != 0 and "did not match any file" in err:
+        # --only refuses untracked paths, so the very first commit of the file needs an add
+        run_git_command(["add", commit_file], repo_path, capture=False)
+        code, out, err = run_git_command(
+            ["commit", "-o", commit_file, "-m", commit_message], repo_path, allow_fail=True
+        )
 
     if code != 0:
-        if "nothing to commit" in err.lower():
+        # git reports "nothing to commit" / "nothing added to commit" on stdout
+        output = (out + err).lower()
+        if "nothing to commit" in output or "nothing added to commit" in output:
             log("No changes to commit; skipping.")
             return
-        log("Commit failed; see logs above.")
+        log(f"Commit failed: {(err or out).strip()}")
         return
 
     log("Commit created.")
 
     if push:
-        code_push, _, err_push = run_git_command(["push"], repo_path, allow_fail=True)
+        code_push, _, err_push = run_git_command(["push"], repo_path, allow_fail=True, capture=False)
         if code_push != 0:
             log(f"Warning: git push failed: {err_push.strip()}")
         else:
@@ -286,10 +478,12 @@ def main() -> None:
     repo_path = config["repo_path"]
 
     ensure_git_repo(repo_path)
-    maybe_set_git_identity(repo_path, config["git_user_name"], config["git_user_email"])
+    git = GitSession(repo_path)
+    maybe_set_git_identity(git, config["git_user_name"], config["git_user_email"])
+    activity_path = ensure_activity_file(repo_path, config["commit_file"])
 
     if args.now:
-        append_activity_line(repo_path, config["commit_file"])
+        append_activity_line(activity_path, datetime.now(), _RNG.choice(ACTIVITY_PHRASES))
         perform_commit(
             repo_path,
             config["commit_file"],
@@ -304,14 +498,16 @@ def main() -> None:
     # Initialize or refresh state
     state = read_state()
     state_date = state.get("date")
-    scheduled_times: List[str] = state.get("scheduled_times", []) if isinstance(state.get("scheduled_times"), list) else []
-
-    def refresh_schedule() -> List[str]:
-        return generate_schedule_for_today(
-            config["work_start_hour"],
-            config["work_end_hour"],
-            config["min_commits"],
-            config["max_commits"],
+    scheduled_times: Deque[ScheduledCommit] = state.get("scheduled_times", deque())
+
+    def refresh_schedule() -> Deque[ScheduledCommit]:
+        return deque(
+            generate_schedule_for_today(
+                config["work_start_hour"],
+                config["work_end_hour"],
+                config["min_commits"],
+                config["max_commits"],
+            )
         )
 
     if state_date != today_str():
@@ -322,7 +518,7 @@ def main() -> None:
     else:
         # Purge past times in case of restart
         now = datetime.now()
-        scheduled_times = [t for t in scheduled_times if datetime.fromisoformat(t) > now]
+        scheduled_times = deque(e for e in scheduled_times if e.time > now)
         state["scheduled_times"] = scheduled_times
         write_state(state)
         log(f"Resuming schedule for {state['date']}: {len(scheduled_times)} commits remaining.")
@@ -336,34 +532,39 @@ def main() -> None:
             write_state(state)
             log(f"New schedule for {state['date']}: {len(scheduled_times)} commits queued.")
 
-        nxt = next_scheduled_time(scheduled_times)
+        # Drop times that passed while we were busy; they are not made up
+        while scheduled_times and scheduled_times[0].time <= now:
+            scheduled_times.popleft()
+
+        nxt = next_scheduled_time(scheduled_times, now)
         if nxt is None:
             # Sleep until next day start minus small margin
             next_day = (now + timedelta(days=1)).replace(hour=config["work_start_hour"], minute=0, second=0, microsecond=0)
             sleep_seconds = max(30.0, (next_day - now).total_seconds())
             log("No commits left today. Sleeping until next window.")
-            # Sleep in small chunks to handle termination
-            slept = 0.0
-            while slept < sleep_seconds and not killer.should_terminate:
-                time.sleep(min(60.0, sleep_seconds - slept))
-                slept += min(60.0, sleep_seconds - slept)
+            killer.sleep(sleep_seconds)
             continue
 
         # Sleep until next scheduled commit
         delta = (nxt - now).total_seconds()
         if delta > 0:
             log(f"Next commit at {nxt.strftime('%H:%M:%S')} (in {int(delta)}s)")
-            slept = 0.0
-            while slept < delta and not killer.should_terminate:
-                step = min(30.0, delta - slept)
-                time.sleep(step)
-                slept += step
+            killer.sleep(delta)
 
         if killer.should_terminate:
             break
 
-        # Make a small change and commit
-        append_activity_line(repo_path, config["commit_file"])
+        # Take every time due within the coalesce window; they share one commit/push
+        window_end = datetime.now() + timedelta(seconds=COALESCE_WINDOW_SECONDS)
+        due: List[ScheduledCommit] = []
+        while scheduled_times and scheduled_times[0].time <= window_end:
+            due.append(scheduled_times.popleft())
+        if len(due) > 1:
+            log(f"Coalescing {len(due)} scheduled commits into one.")
+
+        # Make a small change per scheduled time and commit once
+        for entry in due:
+            append_activity_line(activity_path, entry.time, entry.phrase)
         perform_commit(
             repo_path,
             config["commit_file"],
@@ -371,13 +572,12 @@ def main() -> None:
             config["git_push"],
         )
 
-        # Remove the time we just used and persist state
-        scheduled_times = [t for t in scheduled_times if t != nxt.isoformat()]
+        # Persist the times we just used
         state["scheduled_times"] = scheduled_times
-        write_state(state)
+        record_used_times(state, due)
 
         # Short pause before checking next schedule
-        time.sleep(2)
+        killer.sleep(2)
 
     log("Shutting down.")
 
@@ -386,5 +586,5 @@ if __name__ == "__main__":
     try:
         main()
     except Exception as exc:
-        log(f"Fatal error: {exc}")
+        log(f"Fatal error: {exc}\n{traceback.format_exc().rstrip()}")
         sys.exit(1) 
\ No newline at end of file